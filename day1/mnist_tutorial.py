@@ -36,6 +36,7 @@
 import os
 import shutil
 import tempfile
+from multiprocessing.pool import ThreadPool
 import matplotlib.pyplot as plt
 import PIL
 import torch
@@ -44,22 +45,19 @@ from sklearn.metrics import classification_report
 
 from monai.apps import download_and_extract
 from monai.config import print_config
-from monai.data import decollate_batch
+from monai.data import ThreadDataLoader
 from monai.metrics import ROCAUCMetric
 from monai.networks.nets import DenseNet121
-from monai.transforms import (
-    Activations,
-    AddChannel,
-    AsDiscrete,
-    Compose,
-    LoadImage,
-    RandFlip,
-    RandRotate,
-    RandZoom,
-    ScaleIntensity,
-    EnsureType,
-)
-from monai.utils import set_determinism
+from monai.utils import optional_import, set_determinism
+
+# batched GPU decoding needs torchvision 0.19 or newer
+read_file, has_read_file = optional_import(
+    "torchvision.io", "0.19", name="read_file")
+decode_jpeg, has_decode_jpeg = optional_import(
+    "torchvision.io", "0.19", name="decode_jpeg")
+ImageReadMode, _ = optional_import(
+    "torchvision.io", "0.19", name="ImageReadMode")
+has_nvjpeg = has_read_file and has_decode_jpeg and torch.cuda.is_available()
 
 print_config()
 
@@ -97,10 +95,14 @@ if not os.path.exists(data_dir):
     download_and_extract(resource, compressed_file, root_dir, md5)
 
 # %% [markdown]
-# ## Set deterministic training for reproducibility
+# ## Set random seeds
+# 
+# This seeds the random number generators so the data split and the initial weights are reproducible.  
+# Training itself is not bitwise reproducible, because cuDNN is later allowed to pick the fastest, non-deterministic convolution algorithms.
 
 # %%
 set_determinism(seed=0)
+rng = np.random.default_rng(0)
 
 # %% [markdown]
 # ## Read image filenames from the dataset folders
@@ -139,7 +141,7 @@ print(f"Label counts: {num_each}")
 
 # %%
 plt.subplots(3, 3, figsize=(8, 8))
-for i, k in enumerate(np.random.randint(num_total, size=9)):
+for i, k in enumerate(rng.integers(num_total, size=9)):
     im = PIL.Image.open(image_files_list[k])
     arr = np.array(im)
     plt.subplot(3, 3, i + 1)
@@ -157,8 +159,7 @@ plt.show()
 val_frac = 0.1
 test_frac = 0.1
 length = len(image_files_list)
-indices = np.arange(length)
-np.random.shuffle(indices)
+indices = rng.permutation(length)
 
 test_split = int(test_frac * length)
 val_split = int(val_frac * length) + test_split
@@ -166,81 +167,148 @@ test_indices = indices[:test_split]
 val_indices = indices[test_split:val_split]
 train_indices = indices[val_split:]
 
-train_x = [image_files_list[i] for i in train_indices]
-train_y = [image_class[i] for i in train_indices]
-val_x = [image_files_list[i] for i in val_indices]
-val_y = [image_class[i] for i in val_indices]
-test_x = [image_files_list[i] for i in test_indices]
-test_y = [image_class[i] for i in test_indices]
+image_files_arr = np.array(image_files_list, dtype=object)
+image_class_arr = np.asarray(image_class, dtype=np.int64)
+
+train_x = image_files_arr[train_indices]
+train_y = image_class_arr[train_indices]
+val_x = image_files_arr[val_indices]
+val_y = image_class_arr[val_indices]
+test_x = image_files_arr[test_indices]
+test_y = image_class_arr[test_indices]
 
 print(
     f"Training count: {len(train_x)}, Validation count: "
     f"{len(val_x)}, Test count: {len(test_x)}")
 
 # %% [markdown]
-# ## Define MONAI transforms, Dataset and Dataloader to pre-process data
+# ## Define Dataset and Dataloader to pre-process data
+# 
+# MedNIST easily fits in memory, so every image is decoded only once, into a single uint8 buffer, and the labels are kept in a single int64 tensor.  
+# If torchvision 0.19+ with nvJPEG is available, the JPEGs are decoded in batches on the GPU, otherwise with PIL.  
+# The random rotation, flip and zoom augmentations are applied batch-wise on the GPU by `gpu_augment` in the training loop,  
+# and the 8 bit images are scaled to [0, 1] on the device with a constant instead of per image with `ScaleIntensity`.  
+# As there is no work left to do per item, MONAI's `ThreadDataLoader` collates the batches in a background thread rather than in worker processes,  
+# into pinned memory so that the `non_blocking` copies to the GPU can overlap with compute.
 
 # %%
-train_transforms = Compose(
-    [
-        LoadImage(image_only=True),
-        AddChannel(),
-        ScaleIntensity(),
-        RandRotate(range_x=np.pi / 12, prob=0.5, keep_size=True),
-        RandFlip(spatial_axis=0, prob=0.5),
-        RandZoom(min_zoom=0.9, max_zoom=1.1, prob=0.5),
-        EnsureType(),
-    ]
-)
-
-val_transforms = Compose(
-    [LoadImage(image_only=True), AddChannel(), ScaleIntensity(), EnsureType()])
+def load_image(filename):
+    with PIL.Image.open(filename) as im:
+        return np.array(im, dtype=np.uint8)[None]
+
+
+def decode_images(image_files, chunk_size=1024):
+    images = torch.empty(
+        len(image_files), 1, image_height, image_width, dtype=torch.uint8)
+    if has_nvjpeg:
+        try:
+            for start in range(0, len(image_files), chunk_size):
+                files = image_files[start:start + chunk_size]
+                decoded = decode_jpeg(
+                    [read_file(f) for f in files],
+                    mode=ImageReadMode.GRAY, device="cuda")
+                images[start:start + len(files)] = torch.stack(decoded).cpu()
+            return images
+        except RuntimeError:
+            # torchvision was built without nvJPEG, decode with PIL instead
+            pass
+
+    def load(index):
+        images[index] = torch.from_numpy(load_image(image_files[index]))
+
+    with ThreadPool() as pool:
+        pool.map(load, range(len(image_files)))
+    return images
+
+
+def gpu_augment(images):
+    # batched equivalent of `RandRotate(range_x=np.pi / 12, prob=0.5)`,
+    # `RandFlip(spatial_axis=0, prob=0.5)` and `RandZoom(0.9, 1.1, prob=0.5)`,
+    # run as a single affine warp on the device the images are already on
+    batch, device = images.shape[0], images.device
+
+    def chance():
+        return (torch.rand(batch, device=device) < 0.5).float()
+
+    angle = chance() * torch.empty(batch, device=device).uniform_(
+        -np.pi / 12, np.pi / 12)
+    zoom = 1 + chance() * torch.empty(batch, device=device).uniform_(-0.1, 0.1)
+    flip = 1 - 2 * chance()
+    cos, sin = angle.cos() / zoom, angle.sin() / zoom
+    theta = torch.zeros(batch, 2, 3, device=device)
+    theta[:, 0, 0] = cos
+    theta[:, 0, 1] = -sin * flip
+    theta[:, 1, 0] = sin
+    theta[:, 1, 1] = cos * flip
+    grid = torch.nn.functional.affine_grid(
+        theta, images.shape, align_corners=False)
+    return torch.nn.functional.grid_sample(
+        images, grid, padding_mode="border", align_corners=False)
 
-y_pred_trans = Compose([EnsureType(), Activations(softmax=True)])
-y_trans = Compose([EnsureType(), AsDiscrete(to_onehot=num_class)])
 
 # %%
 class MedNISTDataset(torch.utils.data.Dataset):
-    def __init__(self, image_files, labels, transforms):
-        self.image_files = image_files
-        self.labels = labels
-        self.transforms = transforms
+    def __init__(self, image_files, labels):
+        self.images = decode_images(image_files)
+        self.labels = torch.as_tensor(labels, dtype=torch.long)
 
     def __len__(self):
-        return len(self.image_files)
+        return len(self.images)
 
     def __getitem__(self, index):
-        return self.transforms(self.image_files[index]), self.labels[index]
+        return self.images[index], self.labels[index]
 
 
-train_ds = MedNISTDataset(train_x, train_y, train_transforms)
-train_loader = torch.utils.data.DataLoader(
-    train_ds, batch_size=100, shuffle=True, num_workers=2)
+pin_memory = torch.cuda.is_available()
+batch_size = 256
 
-val_ds = MedNISTDataset(val_x, val_y, val_transforms)
-val_loader = torch.utils.data.DataLoader(
-    val_ds, batch_size=100, num_workers=2)
+train_ds = MedNISTDataset(train_x, train_y)
+# drop the partial last batch, so the compiled model always sees one shape
+train_loader = ThreadDataLoader(
+    train_ds, batch_size=batch_size, shuffle=True, drop_last=True,
+    pin_memory=pin_memory)
 
-test_ds = MedNISTDataset(test_x, test_y, val_transforms)
-test_loader = torch.utils.data.DataLoader(
-    test_ds, batch_size=100, num_workers=2)
+val_ds = MedNISTDataset(val_x, val_y)
+val_loader = ThreadDataLoader(
+    val_ds, batch_size=batch_size, pin_memory=pin_memory)
+
+test_ds = MedNISTDataset(test_x, test_y)
+test_loader = ThreadDataLoader(
+    test_ds, batch_size=batch_size, pin_memory=pin_memory)
 
 # %% [markdown]
 # ## Define network and optimizer
 # 
-# 1. Set learning rate for how much the model is updated per batch.
-# 1. Set total epoch number, as we have shuffle and random transforms, so the training data of every epoch is different.  
+# 1. Set learning rate for how much the model is updated per batch.  
+# It was tuned for a batch size of 100, so it is scaled linearly with the batch size of 256, which mixed precision leaves enough GPU memory for.
+# 1. Set total epoch number, as we have shuffle and random augmentations in `gpu_augment`, so the training data of every epoch is different.  
 # And as this is just a get start tutorial, let's just train 4 epochs.  
 # If train 10 epochs, the model can achieve 100% accuracy on test dataset. 
-# 1. Use DenseNet from MONAI and move to GPU devide, this DenseNet can support both 2D and 3D classification tasks.
+# 1. Use DenseNet from MONAI and move to GPU devide, this DenseNet can support both 2D and 3D classification tasks.  
+# On GPU the model uses the channels last (NHWC) memory layout, which has the fastest FP16 tensor core convolutions,  
+# and with PyTorch 2.0+ it is compiled with `torch.compile` to fuse its many small conv/BN/ReLU layers into fewer kernels.
 # 1. Use Adam optimizer.
+# 1. On GPU, train with automatic mixed precision, using a `GradScaler` to scale the loss.
 
 # %%
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = DenseNet121(spatial_dims=2, in_channels=1,
-                    out_channels=num_class).to(device)
+# there are only a few distinct input shapes (full batches and the smaller
+# last validation and test batches), so let cuDNN benchmark them and pick the
+# fastest convolution algorithms, including non-deterministic ones
+# (`set_determinism` above disables benchmarking and forces deterministic
+# algorithms)
+torch.backends.cudnn.benchmark = True
+torch.backends.cudnn.deterministic = False
+net = DenseNet121(spatial_dims=2, in_channels=1, out_channels=num_class).to(
+    device, memory_format=torch.channels_last)
+# checkpoints are saved from and loaded into the uncompiled `net`
+model = net
+if device.type == "cuda" and hasattr(torch, "compile"):
+    model = torch.compile(net)
 loss_function = torch.nn.CrossEntropyLoss()
-optimizer = torch.optim.Adam(model.parameters(), 1e-5)
+optimizer = torch.optim.Adam(model.parameters(), 1e-5 * batch_size / 100)
+amp = device.type == "cuda"
+scaler = torch.cuda.amp.GradScaler(enabled=amp)
 max_epochs = 4
 val_interval = 1
 auc_metric = ROCAUCMetric()
@@ -249,62 +317,76 @@ auc_metric = ROCAUCMetric()
 # ## Model training
 # 
 # Execute a typical PyTorch training that run epoch loop and step loop, and do validation after every epoch.  
-# Will save the model weights to file if got best validation accuracy.
+# Will save the model weights to file if got best validation accuracy.  
+# The epoch loss is accumulated on the device, and `loss.item()`, which waits for the GPU, is only called every `log_interval` steps.  
+# The validation predictions are written into preallocated buffers, and the accuracy and AUC are both computed on the device from a single softmax.
 
 # %%
 best_metric = -1
 best_metric_epoch = -1
 epoch_loss_values = []
 metric_values = []
+epoch_len = len(train_ds) // train_loader.batch_size
+log_interval = 50
 
 for epoch in range(max_epochs):
     print("-" * 10)
     print(f"epoch {epoch + 1}/{max_epochs}")
     model.train()
-    epoch_loss = 0
+    epoch_loss = torch.zeros((), device=device)
     step = 0
     for batch_data in train_loader:
         step += 1
-        inputs, labels = batch_data[0].to(device), batch_data[1].to(device)
-        optimizer.zero_grad()
-        outputs = model(inputs)
-        loss = loss_function(outputs, labels)
-        loss.backward()
-        optimizer.step()
-        epoch_loss += loss.item()
-        print(
-            f"{step}/{len(train_ds) // train_loader.batch_size}, "
-            f"train_loss: {loss.item():.4f}")
-        epoch_len = len(train_ds) // train_loader.batch_size
-    epoch_loss /= step
+        inputs, labels = (
+            batch_data[0].to(device, non_blocking=True),
+            batch_data[1].to(device, non_blocking=True),
+        )
+        inputs = inputs.float().mul_(1 / 255)
+        inputs = gpu_augment(inputs).contiguous(
+            memory_format=torch.channels_last)
+        optimizer.zero_grad(set_to_none=True)
+        with torch.cuda.amp.autocast(enabled=amp, dtype=torch.float16):
+            outputs = model(inputs)
+            loss = loss_function(outputs, labels)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        epoch_loss += loss.detach()
+        if step % log_interval == 0:
+            print(f"{step}/{epoch_len}, train_loss: {loss.item():.4f}")
+    epoch_loss = epoch_loss.item() / step
     epoch_loss_values.append(epoch_loss)
     print(f"epoch {epoch + 1} average loss: {epoch_loss:.4f}")
 
     if (epoch + 1) % val_interval == 0:
         model.eval()
-        with torch.no_grad():
-            y_pred = torch.tensor([], dtype=torch.float32, device=device)
-            y = torch.tensor([], dtype=torch.long, device=device)
+        with torch.inference_mode(), torch.cuda.amp.autocast(enabled=amp):
+            y_pred = torch.empty(
+                len(val_ds), num_class, dtype=torch.float32, device=device)
+            y = torch.empty(len(val_ds), dtype=torch.long, device=device)
+            offset = 0
             for val_data in val_loader:
                 val_images, val_labels = (
-                    val_data[0].to(device),
-                    val_data[1].to(device),
+                    val_data[0].to(device, non_blocking=True),
+                    val_data[1].to(device, non_blocking=True),
                 )
-                y_pred = torch.cat([y_pred, model(val_images)], dim=0)
-                y = torch.cat([y, val_labels], dim=0)
-            y_onehot = [y_trans(i) for i in decollate_batch(y)]
-            y_pred_act = [y_pred_trans(i) for i in decollate_batch(y_pred)]
-            auc_metric(y_pred_act, y_onehot)
+                val_images = val_images.float().mul_(1 / 255).contiguous(
+                    memory_format=torch.channels_last)
+                batch = val_labels.size(0)
+                y_pred[offset:offset + batch] = model(val_images)
+                y[offset:offset + batch] = val_labels
+                offset += batch
+            probs = y_pred.softmax(dim=1)
+            acc_value = (probs.argmax(dim=1) == y).float().mean()
+            auc_metric(probs, torch.nn.functional.one_hot(y, num_class))
             result = auc_metric.aggregate()
             auc_metric.reset()
-            del y_pred_act, y_onehot
             metric_values.append(result)
-            acc_value = torch.eq(y_pred.argmax(dim=1), y)
-            acc_metric = acc_value.sum().item() / len(acc_value)
+            acc_metric = acc_value.item()
             if result > best_metric:
                 best_metric = result
                 best_metric_epoch = epoch + 1
-                torch.save(model.state_dict(), os.path.join(
+                torch.save(net.state_dict(), os.path.join(
                     root_dir, "best_metric_model.pth"))
                 print("saved new best metric model")
             print(
@@ -345,21 +427,24 @@ plt.show()
 # We'll use these predictions to generate a classification report.
 
 # %%
-model.load_state_dict(torch.load(
+net.load_state_dict(torch.load(
     os.path.join(root_dir, "best_metric_model.pth")))
 model.eval()
 y_true = []
 y_pred = []
-with torch.no_grad():
+with torch.inference_mode(), torch.cuda.amp.autocast(enabled=amp):
     for test_data in test_loader:
         test_images, test_labels = (
-            test_data[0].to(device),
-            test_data[1].to(device),
+            test_data[0].to(device, non_blocking=True),
+            test_data[1].to(device, non_blocking=True),
         )
+        test_images = test_images.float().mul_(1 / 255).contiguous(
+            memory_format=torch.channels_last)
         pred = model(test_images).argmax(dim=1)
-        for i in range(len(pred)):
-            y_true.append(test_labels[i].item())
-            y_pred.append(pred[i].item())
+        y_true.append(test_labels.cpu().numpy())
+        y_pred.append(pred.cpu().numpy())
+y_true = np.concatenate(y_true)
+y_pred = np.concatenate(y_pred)
 
 # %%
 print(classification_report(